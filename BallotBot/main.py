@@ -1,177 +1,482 @@
+import contextlib
+import functools
 import json
 import os
+import pickle
 import praw
+import queue
+import sys
 import threading
+import time
+from collections import defaultdict
 from datetime import datetime, timezone
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
 REDDIT_SITE_NAME = 'ballot_bot'
 SUBREDDIT_NAME = 'dndhomebrew'
 FLAIR_TEXT = 'Official'
-VALID_VOTES = {'yes', 'no'}
+VALID_VOTES = frozenset({'yes', 'no'})
+MAX_VOTE_LENGTH = max(map(len, VALID_VOTES))
 CUTOFF_DATE = datetime(2025, 4, 20, tzinfo=timezone.utc)
+CUTOFF_TS = CUTOFF_DATE.timestamp()
 ACTIVITY_DEPTH_CHECK = 100
 USER_CACHE_FILE = 'known_users.json'
+USER_CACHE_PICKLE = 'known_users.pkl'
+USER_CACHE_LOCK = 'known_users.lock'
 LOG_FILE = 'log.txt'
+SAVE_DEBOUNCE_SECONDS = 2
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_SECONDS = 0.5
+COMMENT_BATCH_SECONDS = 0.25
+IDLE_POLL_MAX_SECONDS = 16
+MODMAIL_WORKERS = 2
+SEARCH_CACHE_SECONDS = 60
 
 user_data_lock = threading.Lock()
+_USER_DATA = {}
+_user_locks = defaultdict(threading.Lock)
+_dirty = False
+_save_event = threading.Event()
+_save_lock = threading.Lock()
+_log_queue = queue.Queue()
+_modmail_queue = queue.Queue()
+_stop_event = threading.Event()
+_log_timestamp = (None, '')
 
 # Initialize Reddit instance using praw.ini
 reddit = praw.Reddit(site_name=REDDIT_SITE_NAME)
 subreddit = reddit.subreddit('dndhomebrew')
 
+@contextlib.contextmanager
+def user_cache_file_lock():
+    # Exclusive cross-process lock, held only while cache files are read or replaced
+    with open(USER_CACHE_LOCK, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        elif msvcrt:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            elif msvcrt:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def encode_json(data):
+    # Compact, key-sorted output; orjson is used when installed
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+
+def decode_json(raw):
+    if orjson:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def write_user_pickle(data):
+    tmp_file = f'{USER_CACHE_PICKLE}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, USER_CACHE_PICKLE)
+
+def read_user_cache():
+    # Prefer the pickle sidecar when it is at least as new as the JSON file
+    if os.path.exists(USER_CACHE_PICKLE) and os.path.getmtime(USER_CACHE_PICKLE) >= os.path.getmtime(USER_CACHE_FILE):
+        try:
+            with open(USER_CACHE_PICKLE, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            log_action(f'Error loading pickled user cache: {e}')
+    with open(USER_CACHE_FILE, 'rb') as f:
+        data = decode_json(f.read())
+    try:
+        write_user_pickle(data)
+    except Exception as e:
+        log_action(f'Error saving pickled user cache: {e}')
+    return data
+
 def load_user_data():
     if not os.path.exists(USER_CACHE_FILE):
         log_action('User cache file not found. Initializing new cache.')
-        return {'whitelist': [], 'blacklist': [], 'votes': {}}
+        return {'whitelist': set(), 'blacklist': set(), 'votes': {}}
     try:
-        with open(USER_CACHE_FILE, 'r') as f:
-            return json.load(f)
+        with user_cache_file_lock():
+            data = read_user_cache()
+        # Lists on disk, sets in memory for O(1) membership checks
+        data['whitelist'] = set(data['whitelist'])
+        data['blacklist'] = set(data['blacklist'])
+        return data
     except Exception as e:
         log_action(f'Error loading user cache: {e}', print_to_screen=True)
-        return {'whitelist': [], 'blacklist': [], 'votes': {}}
+        return {'whitelist': set(), 'blacklist': set(), 'votes': {}}
 
-def save_user_data(data):
-    try:
-        with open(USER_CACHE_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        log_action(f'Error saving user cache: {e}', print_to_screen=True)
+def save_user_data():
+    # Caller must hold user_data_lock; the writer thread persists the change
+    global _dirty
+    _dirty = True
+    _save_event.set()
+
+def flush_user_data():
+    global _dirty
+    with _save_lock:
+        with user_data_lock:
+            if not _dirty:
+                return
+            snapshot = {
+                'whitelist': sorted(_USER_DATA['whitelist']),
+                'blacklist': sorted(_USER_DATA['blacklist']),
+                'votes': dict(_USER_DATA['votes']),
+            }
+            _dirty = False
+        # Per-process temp file so concurrent writers can't swap in each other's partial output
+        tmp_file = f'{USER_CACHE_FILE}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(encode_json(snapshot))
+            with user_cache_file_lock():
+                os.replace(tmp_file, USER_CACHE_FILE)
+                write_user_pickle(snapshot)
+        except Exception as e:
+            with user_data_lock:
+                _dirty = True
+            log_action(f'Error saving user cache: {e}', print_to_screen=True)
+
+def add_to_whitelist(name):
+    # Returns whether the user was newly whitelisted and whether they had been blacklisted
+    with user_data_lock:
+        added = name not in _USER_DATA['whitelist']
+        was_blacklisted = name in _USER_DATA['blacklist']
+        _USER_DATA['whitelist'].add(name)
+        _USER_DATA['blacklist'].discard(name)
+        save_user_data()
+    return added, was_blacklisted
+
+def add_to_blacklist(name):
+    with user_data_lock:
+        _USER_DATA['blacklist'].add(name)
+        save_user_data()
+
+def user_data_writer():
+    # Coalesce bursts of mutations into a single write
+    while True:
+        _save_event.wait()
+        time.sleep(SAVE_DEBOUNCE_SECONDS)
+        _save_event.clear()
+        flush_user_data()
 
 def log_action(message, print_to_screen=False):
-    timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+    # Reformat the timestamp at most once per second
+    global _log_timestamp
+    sec = int(time.time())
+    cached_sec, timestamp = _log_timestamp
+    if sec != cached_sec:
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(sec))
+        _log_timestamp = (sec, timestamp)
     formatted_message = f'[{timestamp}] {message}\n'
+    _log_queue.put_nowait(formatted_message)
+    if (print_to_screen):
+        print(formatted_message)
+
+def log_writer():
+    # Keep the log file open and write queued messages in batches
     with open(LOG_FILE, 'a') as f:
-        f.write(formatted_message)
-        if (print_to_screen):
-            print(formatted_message)
+        while True:
+            batch = [_log_queue.get()]
+            deadline = time.monotonic() + LOG_FLUSH_SECONDS
+            while len(batch) < LOG_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(_log_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                f.writelines(batch)
+                f.flush()
+            except Exception as e:
+                print(f'Error writing log file: {e}', file=sys.stderr)
+            finally:
+                for _ in batch:
+                    _log_queue.task_done()
+
+_log_thread = threading.Thread(target=log_writer, daemon=True)
+
+def flush_log():
+    # Joining a queue whose writer has died would block forever
+    if _log_thread.is_alive():
+        _log_queue.join()
 
 def send_modmail(recipient, subject, body):
+    # Delivered by a modmail worker so comment handling isn't blocked on the API
+    _modmail_queue.put((recipient, subject, body))
+
+def deliver_modmail(recipient, subject, body):
     try:
         reddit.subreddit(SUBREDDIT_NAME).modmail.create(subject=subject, body=body, recipient=recipient).archive()
         log_action(f'Sent modmail to {recipient}: {subject}')
     except Exception as e:
         log_action(f'Failed to send modmail to {recipient}: {e}', print_to_screen=True)
 
+def modmail_worker():
+    while True:
+        recipient, subject, body = _modmail_queue.get()
+        try:
+            deliver_modmail(recipient, subject, body)
+        finally:
+            _modmail_queue.task_done()
+
+def flush_modmail():
+    _modmail_queue.join()
+
+@functools.lru_cache(maxsize=8)
+def _search_newest(query, ttl_bucket):
+    # ttl_bucket changes every SEARCH_CACHE_SECONDS, expiring older entries
+    return next(subreddit.search(query, sort='new', limit=1), None)
+
 def get_latest_post_by_flair(flair):
-    return next(subreddit.search(f'flair:"{flair}"', sort='new', limit=1), None)
+    return _search_newest(f'flair:"{flair}"', int(time.time() // SEARCH_CACHE_SECONDS))
 
 def get_post_by_title(title):
-    return next(subreddit.search(f'title:"{title}"', sort='new', limit=1), None)
+    return _search_newest(f'title:"{title}"', int(time.time() // SEARCH_CACHE_SECONDS))
+
+def activity_known(name):
+    # Returns True/False for cached users, None if history must be checked
+    with user_data_lock:
+        if name in _USER_DATA['whitelist']:
+            return True
+        if name in _USER_DATA['blacklist']:
+            return False
+    return None
 
-def has_prior_activity(author):
+def prefetch_account_ages(comments):
+    # Look up creation times for all unknown authors in one batched request
+    try:
+        fullnames = {
+            comment.author_fullname
+            for comment in comments
+            if comment.author and activity_known(comment.author.name.lower()) is None
+        }
+        if not fullnames:
+            return {}
+        return {
+            redditor.name.lower(): redditor.created_utc
+            for redditor in reddit.redditors.partial_redditors(fullnames)
+        }
+    except Exception as e:
+        log_action(f'Error prefetching account ages: {e}', print_to_screen=True)
+        return {}
+
+def has_prior_activity(author, created_utc=None):
     if not author:
         return False
 
     name = author.name.lower()
     with user_data_lock:
-        data = load_user_data()
+        user_lock = _user_locks[name]
 
-        # Check cache before making requests
-        if name in data['whitelist']:
-            return True
-        if name in data['blacklist']:
+    try:
+        # Serialize checks for the same user without blocking other users during history requests
+        with user_lock:
+            # Check cache before making requests
+            known = activity_known(name)
+            if known is not None:
+                return known
+
+            try:
+                # PRAW fetches the subreddit once, later accesses are free
+                subreddit_id = subreddit.fullname
+                # Accounts created after the cutoff cannot have prior activity, skip the history scans
+                if created_utc is None:
+                    created_utc = author.created_utc
+                if created_utc >= CUTOFF_TS:
+                    add_to_blacklist(name)
+                    log_action(f'User {name} added to blacklist: account created after cutoff.')
+                    return False
+                # Check user comment history
+                for comment in author.comments.new(limit=ACTIVITY_DEPTH_CHECK):
+                    if comment.subreddit_id == subreddit_id and comment.created_utc < CUTOFF_TS:
+                        add_to_whitelist(name)
+                        log_action(f'User {name} added to whitelist via comment history.')
+                        return True
+                # Check user post history
+                for submission in author.submissions.new(limit=ACTIVITY_DEPTH_CHECK):
+                    if submission.subreddit_id == subreddit_id and submission.created_utc < CUTOFF_TS:
+                        add_to_whitelist(name)
+                        log_action(f'User {name} added to whitelist via post history.')
+                        return True
+            except Exception as e:
+                log_action(f'Error checking prior activity for {name}: {e}', print_to_screen=True)
+
+            # Blacklist user if not active
+            add_to_blacklist(name)
+            log_action(f'User {name} added to blacklist.')
             return False
+    finally:
+        # The user is cached by now, so the lock is no longer needed
+        with user_data_lock:
+            _user_locks.pop(name, None)
 
-        try:
-            # Check user comment history
-            for comment in author.comments.new(limit=ACTIVITY_DEPTH_CHECK):
-                comment_created_time = datetime.fromtimestamp(comment.created_utc).replace(tzinfo=timezone.utc)
-                if comment.subreddit.display_name.lower() == SUBREDDIT_NAME and comment_created_time < CUTOFF_DATE:
-                    data['whitelist'].append(name)
-                    save_user_data(data)
-                    log_action(f'User {name} added to whitelist via comment history.')
-                    return True
-            # Check user post history
-            for submission in author.submissions.new(limit=ACTIVITY_DEPTH_CHECK):
-                submission_created_time = datetime.fromtimestamp(submission.created_utc).replace(tzinfo=timezone.utc)
-                if submission.subreddit.display_name.lower() == SUBREDDIT_NAME and submission_created_time < CUTOFF_DATE:
-                    data['whitelist'].append(name)
-                    save_user_data(data)
-                    log_action(f'User {name} added to whitelist via post history.')
-                    return True
-        except Exception as e:
-            log_action(f'Error checking prior activity for {name}: {e}', print_to_screen=True)
+def process_comment(comment, account_ages):
+    try:
+        author = comment.author
+        username = author.name
+        content = comment.body.strip()
+        # Only lowercase bodies short enough to be a vote
+        if len(content) <= MAX_VOTE_LENGTH:
+            content = content.lower()
+        if not has_prior_activity(author, account_ages.get(username.lower())):
+            # Comments made by accounts with insufficient history will be removed and not recorded
+            comment.mod.remove()
+            log_action(f'Removed comment by {username}: not a known user.')
+            send_modmail(
+                username,
+                'Your Vote Was Removed',
+                f"Your comment was removed because your account hasn't participated in r/DnDHomebrew prior to April 20, 2025. If this is a mistake, please [message the moderators](https://www.reddit.com/message/compose?to=/r/{SUBREDDIT_NAME}) with a link to a post or comment you made in the subreddit before the cutoff date."
+            )
+        elif content not in VALID_VOTES:
+            # Comments made that are not votes will be removed and not recorded
+            comment.mod.remove()
+            log_action(f'Removed invalid vote comment by {username}: "{content}"')
+            send_modmail(
+                username,
+                'Your Vote Was Removed',
+                'Only "yes" and "no" are valid responses in this community vote.'
+            )
+        else:
+            # Comments left by active accounts that are votes will be recorded
+            comment.mod.remove()
+            with user_data_lock:
+                _USER_DATA['votes'][username] = content
+                save_user_data()
+            log_action(f'Recorded vote by {username}: {content}')
+            send_modmail(
+                username,
+                'Vote Recorded',
+                f'Thanks for voting! Your response ({content}) has been recorded. You may change your response at any time before the vote ends by re-commenting with your new response.'
+            )
+    except Exception as e:
+        log_action(f'Encountered an error: {e}', print_to_screen=True)
 
-        # Blacklist user if not active
-        data['blacklist'].append(name)
-        save_user_data(data)
-        log_action(f'User {name} added to blacklist.')
-        return False
+def process_batch(comments):
+    account_ages = prefetch_account_ages(comments)
+    for comment in comments:
+        # Stop recording votes once shutdown has started
+        if _stop_event.is_set():
+            return
+        process_comment(comment, account_ages)
 
 def monitor_comments(post):
-    for comment in subreddit.stream.comments():
+    target_link = f't3_{post.id}'
+    pending = []
+    batch_deadline = 0
+    idle_delay = 1
+    # pause_after=0 yields None once a poll has no new comments, flushing the batch.
+    # PRAW skips its own backoff in that case, so idle polls back off here instead.
+    for comment in subreddit.stream.comments(pause_after=0):
+        if _stop_event.is_set():
+            break
+        if comment is None:
+            if pending:
+                try:
+                    process_batch(pending)
+                except Exception as e:
+                    log_action(f'Encountered an error: {e}', print_to_screen=True)
+                pending = []
+            else:
+                _stop_event.wait(idle_delay)
+                idle_delay = min(idle_delay * 2, IDLE_POLL_MAX_SECONDS)
+            continue
+        idle_delay = 1
         try:
-            if comment.submission == post:
-                author = comment.author
-                username = author.name
-                content = comment.body.strip().lower()
-                if not has_prior_activity(comment.author):
-                    # Comments made by accounts with insufficient history will be removed and not recorded
-                    comment.mod.remove()
-                    log_action(f'Removed comment by {username}: not a known user.')
-                    send_modmail(
-                        username,
-                        'Your Vote Was Removed',
-                        f"Your comment was removed because your account hasn't participated in r/DnDHomebrew prior to April 20, 2025. If this is a mistake, please [message the moderators](https://www.reddit.com/message/compose?to=/r/{SUBREDDIT_NAME}) with a link to a post or comment you made in the subreddit before the cutoff date."
-                    )
-                elif content not in VALID_VOTES:
-                    # Comments made that are not votes will be removed and not recorded
-                    comment.mod.remove()
-                    log_action(f'Removed invalid vote comment by {username}: "{content}"')
-                    send_modmail(
-                        username,
-                        'Your Vote Was Removed',
-                        'Only "yes" and "no" are valid responses in this community vote.'
-                    )
-                else:
-                    # Comments left by active accounts that are votes will be recorded
-                    comment.mod.remove()
-                    with user_data_lock:
-                        data = load_user_data()
-                        data['votes'][username] = content
-                        save_user_data(data)
-                        log_action(f'Recorded vote by {username}: {content}')
-                        send_modmail(
-                            username,
-                            'Vote Recorded',
-                            f'Thanks for voting! Your response ({content}) has been recorded. You may change your response at any time before the vote ends by re-commenting with your new response.'
-                        )
+            if comment.link_id == target_link:
+                if not pending:
+                    batch_deadline = time.monotonic() + COMMENT_BATCH_SECONDS
+                pending.append(comment)
         except Exception as e:
             log_action(f'Encountered an error: {e}', print_to_screen=True)
+        if pending and time.monotonic() >= batch_deadline:
+            try:
+                process_batch(pending)
+            except Exception as e:
+                log_action(f'Encountered an error: {e}', print_to_screen=True)
+            pending = []
+
+def cmd_whitelist(username):
+    # whitelist <username>
+    username = username.strip()
+    if not username:
+        return
+    added, was_blacklisted = add_to_whitelist(username)
+    if added:
+        log_action(f'User {username} added to whitelist via terminal.', print_to_screen=True)
+    if was_blacklisted:
+        log_action(f'User {username} removed from blacklist.', print_to_screen=True)
+    send_modmail(
+        username,
+        'User Added to Whitelist',
+        f'You have been added to the whitelist for the community vote! Thank you for your patience. Comment on the post again to cast your vote.'
+    )
+
+def cmd_exit(_):
+    print('Closing script')
+    _stop_event.set()
+    flush_user_data()
+    flush_modmail()
+    # Votes recorded while modmail drained were only marked dirty
+    flush_user_data()
+    flush_log()
+    os._exit(0)
+
+def cmd_unknown(_):
+    pass
+
+TERMINAL_COMMANDS = {
+    'whitelist': cmd_whitelist,
+    'exit': cmd_exit,
+}
 
 def monitor_terminal():
     # Check terminal for commands
     while True:
         try:
-            cmd = input().strip().lower()
-            # whitelist <username>
-            if cmd.startswith('whitelist '):
-                username = cmd.split(' ', 1)[1].strip()
-                with user_data_lock:
-                    data = load_user_data()
-                    if username not in data['whitelist']:
-                        data['whitelist'].append(username)
-                        log_action(f'User {username} added to whitelist via terminal.', print_to_screen=True)
-                    if username in data['blacklist']:
-                        data['blacklist'].remove(username)
-                        log_action(f'User {username} removed from blacklist.', print_to_screen=True)
-                    save_user_data(data)
-                    send_modmail(
-                        username,
-                        'User Added to Whitelist',
-                        f'You have been added to the whitelist for the community vote! Thank you for your patience. Comment on the post again to cast your vote.'
-                    )
-            # exit
-            elif cmd == 'exit':
-                print('Closing script')
-                os._exit(0)
+            verb, _, arg = input().strip().lower().partition(' ')
+            TERMINAL_COMMANDS.get(verb, cmd_unknown)(arg)
         except Exception as e:
             log_action(f'Error processing terminal command: {e}', print_to_screen=True)
 
 def main():
+    _log_thread.start()
+    with user_data_lock:
+        _USER_DATA.update(load_user_data())
+    threading.Thread(target=user_data_writer, daemon=True).start()
+    for _ in range(MODMAIL_WORKERS):
+        threading.Thread(target=modmail_worker, daemon=True).start()
     threading.Thread(target=monitor_terminal, daemon=True).start()
     post = get_latest_post_by_flair(FLAIR_TEXT)
-    monitor_comments(post)
+    try:
+        monitor_comments(post)
+    finally:
+        flush_user_data()
+        flush_modmail()
+        flush_log()
     
 if __name__ == '__main__':
     main()